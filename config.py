@@ -23,6 +23,8 @@ class Settings(BaseSettings):
     REELS_HEIGHT: int = 1920
     FFMPEG_PRESET: str = "veryfast"
     FFMPEG_CRF: int = 28
+    MAX_CONCURRENT_PROCESSING: int = 0  # 0 = auto (CPU count, or 2 with a hardware encoder)
+    PROCESSING_TIMEOUT: int = 0  # seconds per clip encode, 0 = no limit
     
     # Security
     ALLOWED_ORIGINS: List[str] = ["*"]
@@ -31,6 +33,7 @@ class Settings(BaseSettings):
     # Files
     OUTPUT_DIR: str = "output"
     TEMP_DIR: str = "temp"
+    SHM_TEMP_BYTES: int = 0  # /dev/shm budget for job intermediates, 0 = off
     LOG_DIR: str = "logs"
     
     # Download
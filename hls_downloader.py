@@ -0,0 +1,130 @@
+"""
+Parallel HLS prefetch: mirrors a playlist and its segments into a local directory
+"""
+import asyncio
+import os
+import re
+import logging
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Segments fetched at once per playlist
+SEGMENT_CONCURRENCY = 32
+
+ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+URI_RE = re.compile(r'URI="([^"]*)"')
+
+
+def parse_attributes(line: str) -> Dict[str, str]:
+    """Parse the KEY=VALUE list of an #EXT-X tag"""
+    _, _, attributes = line.partition(":")
+    return {key: value.strip('"') for key, value in ATTRIBUTE_RE.findall(attributes)}
+
+
+class HlsDownloader:
+    """
+    Downloads every segment of an HLS stream concurrently and writes a local
+    playlist pointing at them, so ffmpeg reads from disk instead of fetching
+    segments one after another.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, output_dir: str):
+        self.session = session
+        self.output_dir = output_dir
+        self.semaphore = asyncio.Semaphore(SEGMENT_CONCURRENCY)
+
+    async def download(self, url: str) -> str:
+        """Mirror the playlist at url and return the local playlist path"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        text = await self.fetch_text(url)
+        if "#EXT-X-STREAM-INF" not in text:
+            return await self.mirror_media(url, text, "video")
+
+        variant, audio = self.select_renditions(text)
+        if variant is None:
+            raise ValueError("Master playlist has no variants")
+        stream_inf, variant_uri = variant
+        lines = ["#EXTM3U"]
+        jobs = [self.mirror_media(urljoin(url, variant_uri), None, "video")]
+        if audio is not None:
+            lines.append(URI_RE.sub('URI="audio.m3u8"', audio))
+            jobs.append(self.mirror_media(urljoin(url, URI_RE.search(audio).group(1)), None, "audio"))
+        await asyncio.gather(*jobs)
+        lines += [stream_inf, "video.m3u8"]
+
+        path = os.path.join(self.output_dir, "master.m3u8")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def select_renditions(self, text: str) -> Tuple[Optional[Tuple[str, str]], Optional[str]]:
+        """Pick the highest-bandwidth variant and its default audio rendition"""
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        variants = []
+        audio_media = []
+        for i, line in enumerate(lines):
+            if line.startswith("#EXT-X-STREAM-INF") and i + 1 < len(lines) and not lines[i + 1].startswith("#"):
+                variants.append((line, lines[i + 1]))
+            elif line.startswith("#EXT-X-MEDIA") and URI_RE.search(line):
+                attributes = parse_attributes(line)
+                if attributes.get("TYPE") == "AUDIO":
+                    audio_media.append((attributes, line))
+        if not variants:
+            return None, None
+
+        variant = max(variants, key=lambda v: int(parse_attributes(v[0]).get("BANDWIDTH", 0) or 0))
+        group = parse_attributes(variant[0]).get("AUDIO")
+        candidates = [(attributes, line) for attributes, line in audio_media if attributes.get("GROUP-ID") == group]
+        if not candidates:
+            return variant, None
+        default = next((line for attributes, line in candidates if attributes.get("DEFAULT") == "YES"), candidates[0][1])
+        return variant, default
+
+    async def mirror_media(self, url: str, text: Optional[str], name: str) -> str:
+        """Download all segments of a media playlist and write a local copy"""
+        if text is None:
+            text = await self.fetch_text(url)
+        if any(line.startswith("#EXT-X-KEY") and "METHOD=NONE" not in line for line in text.splitlines()):
+            raise ValueError("Encrypted playlists are not prefetched")
+
+        local_names: Dict[str, str] = {}
+        output: List[str] = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith("#EXT-X-MAP"):
+                uri = URI_RE.search(line).group(1)
+                line = URI_RE.sub(f'URI="{self.local_name(urljoin(url, uri), name, local_names)}"', line)
+            elif line and not line.startswith("#"):
+                line = self.local_name(urljoin(url, line), name, local_names)
+            output.append(line)
+
+        # Byte-range playlists reference one file many times; fetch it once
+        await asyncio.gather(*(self.fetch_file(remote, local) for remote, local in local_names.items()))
+
+        path = os.path.join(self.output_dir, f"{name}.m3u8")
+        with open(path, "w") as f:
+            f.write("\n".join(output) + "\n")
+        return path
+
+    def local_name(self, remote: str, name: str, local_names: Dict[str, str]) -> str:
+        if remote not in local_names:
+            extension = os.path.splitext(urlparse(remote).path)[1] or ".ts"
+            local_names[remote] = f"{name}_{len(local_names):05}{extension}"
+        return local_names[remote]
+
+    async def fetch_text(self, url: str) -> str:
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    async def fetch_file(self, url: str, local: str):
+        async with self.semaphore:
+            async with self.session.get(url) as response:
+                response.raise_for_status()
+                data = await response.read()
+        with open(os.path.join(self.output_dir, local), "wb") as f:
+            f.write(data)
@@ -2,38 +2,68 @@
 import os
 import uuid
 import logging
+import logging.handlers
+import queue
 import asyncio
 from pathlib import Path
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, HttpUrl, Field
-from contextlib import asynccontextmanager
-import tempfile
-import shutil
+from contextlib import asynccontextmanager, suppress
 import redis.asyncio as redis
 
 from config import settings
-from video_processor import VideoProcessor
 
-logging.basicConfig(level=logging.INFO)
+# Log records are handed off through a queue; a listener thread does the I/O
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
 logger = logging.getLogger(__name__)
 
 redis_client: Optional[redis.Redis] = None
+write_batcher: Optional["RedisWriteBatcher"] = None
+
+PROGRESS_INTERVAL = 0.25
+SINGLE_PASS_MAX_CLIPS = 6
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_DELAY = 0.005
+REDIS_WARMUP_TIMEOUT = 3.0
+WRITE_FLUSH_TIMEOUT = 5.0
+TERMINAL_STATUSES = ("completed", "failed")
+
+def make_dirs():
+    for directory in ("output", "logs", "temp"):
+        Path(directory).mkdir(exist_ok=True)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global redis_client
-    Path("output").mkdir(exist_ok=True)
-    Path("logs").mkdir(exist_ok=True)
-    Path("temp").mkdir(exist_ok=True)
-    redis_client = await redis.from_url(settings.REDIS_URL, decode_responses=True)
+    global redis_client, write_batcher
+    pool = redis.BlockingConnectionPool.from_url(settings.REDIS_URL, max_connections=50, decode_responses=True)
+    redis_client = redis.Redis(connection_pool=pool)
+    # Create directories and open the first Redis connection concurrently
+    dirs, ping = await asyncio.gather(asyncio.to_thread(make_dirs), asyncio.wait_for(redis_client.ping(), timeout=REDIS_WARMUP_TIMEOUT), return_exceptions=True)
+    if isinstance(dirs, Exception):
+        raise dirs
+    log_listener = logging.handlers.QueueListener(
+        log_queue,
+        logging.StreamHandler(),
+        logging.handlers.RotatingFileHandler("logs/app.log", maxBytes=10 * 1024 * 1024, backupCount=5),
+    )
+    log_listener.start()
+    if isinstance(ping, Exception):
+        logger.warning(f"Redis warmup failed: {ping!r}")
+    write_batcher = RedisWriteBatcher(redis_client)
+    write_batcher.start()
     yield
+    await write_batcher.stop()
+    write_batcher = None
     if redis_client:
         await redis_client.close()
+        await pool.disconnect()
+    log_listener.stop()
 
-app = FastAPI(title="M3U8 Video Merger API", lifespan=lifespan)
+app = FastAPI(title="M3U8 Video Merger API", lifespan=lifespan, default_response_class=ORJSONResponse)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
 class RedditVideo(BaseModel):
@@ -60,48 +90,168 @@ class JobStatus(BaseModel):
     output_file: Optional[str] = None
     error: Optional[str] = None
 
+def get_redis_client() -> Optional[redis.Redis]:
+    return redis_client
+
 async def get_redis():
     if redis_client is None:
         raise HTTPException(status_code=503, detail="Redis not available")
     return redis_client
 
 async def store_job(redis_conn: redis.Redis, job_id: str, status: str, progress: str = "", output: str = "", error: str = ""):
-    await redis_conn.hset(f"job:{job_id}", mapping={"status": status, "progress": progress, "output_file": output, "error": error})
-    await redis_conn.expire(f"job:{job_id}", settings.JOB_RETENTION_SECONDS)
+    job_key = f"job:{job_id}"
+    mapping = {"status": status, "progress": progress, "output_file": output, "error": error}
+    if status != "queued":
+        # Retention is anchored to job creation; HSET keeps the existing TTL
+        if write_batcher is not None:
+            flushed = write_batcher.hset(job_key, mapping)
+            if status in TERMINAL_STATUSES and not await flushed:
+                # Clients poll until they see a terminal state, so don't lose it with the batch
+                await redis_conn.hset(job_key, mapping=mapping)
+        else:
+            await redis_conn.hset(job_key, mapping=mapping)
+        return
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.hset(job_key, mapping=mapping)
+        pipe.expire(job_key, settings.JOB_RETENTION_SECONDS)
+        await pipe.execute()
+
+class RedisWriteBatcher:
+    """Batches HSETs from all jobs and flushes them together in one pipeline"""
+
+    def __init__(self, redis_conn: redis.Redis, max_batch: int = WRITE_BATCH_SIZE, max_delay: float = WRITE_BATCH_DELAY):
+        self.redis_conn = redis_conn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = WRITE_FLUSH_TIMEOUT):
+        # Flush whatever is still queued, but don't let a Redis outage hold up shutdown
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self._queue.qsize()} unflushed job updates")
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        while not self._queue.empty():
+            *_, flushed = self._queue.get_nowait()
+            flushed.set_result(False)
+
+    def hset(self, key: str, mapping: dict) -> asyncio.Future:
+        """Queue an HSET; the returned future resolves to whether its batch was written"""
+        flushed = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((key, mapping, flushed))
+        return flushed
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            written = False
+            try:
+                await asyncio.sleep(self.max_delay)
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                # A single FIFO consumer keeps per-job write order
+                async with self.redis_conn.pipeline(transaction=False) as pipe:
+                    for key, mapping, _ in batch:
+                        pipe.hset(key, mapping=mapping)
+                    await pipe.execute()
+                written = True
+            except Exception as e:
+                logger.error(f"Failed to flush {len(batch)} job updates: {e}")
+            finally:
+                for *_, flushed in batch:
+                    if not flushed.done():
+                        flushed.set_result(written)
+                    self._queue.task_done()
 
 async def get_job(redis_conn: redis.Redis, job_id: str):
     return await redis_conn.hgetall(f"job:{job_id}")
 
-async def process_merge_job(job_id: str, request: MergeRequest):
-    redis_conn = await redis.from_url(settings.REDIS_URL, decode_responses=True)
+class ProgressReporter:
+    """Debounces per-video progress writes; phase transitions are written immediately"""
+
+    def __init__(self, redis_conn: redis.Redis, job_id: str, interval: float = PROGRESS_INTERVAL):
+        self.redis_conn = redis_conn
+        self.job_id = job_id
+        self.interval = interval
+        self._pending: Optional[tuple] = None
+        self._last_write = 0.0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def report(self, status: str, progress: str):
+        self._pending = (status, progress)
+        if self._flush_task is None:
+            delay = max(0.0, self._last_write + self.interval - asyncio.get_running_loop().time())
+            self._flush_task = asyncio.create_task(self._flush_later(delay))
+
+    async def update(self, status: str, progress: str = "", output: str = "", error: str = ""):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self._pending = None
+        async with self._lock:
+            self._last_write = asyncio.get_running_loop().time()
+            await store_job(self.redis_conn, self.job_id, status, progress, output=output, error=error)
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._flush_task = None
+        async with self._lock:
+            if self._pending is None:
+                return
+            status, progress = self._pending
+            self._pending = None
+            self._last_write = asyncio.get_running_loop().time()
+            await store_job(self.redis_conn, self.job_id, status, progress)
+
+async def process_merge_job(job_id: str, payload: dict):
+    from video_processor import VideoProcessor, make_temp_dir, probe_capabilities, remove_temp_dir
+    reporter = ProgressReporter(get_redis_client(), job_id)
     temp_dir = None
     try:
-        await store_job(redis_conn, job_id, "downloading", "Starting...")
-        temp_dir = tempfile.mkdtemp(dir="temp")
+        await reporter.update("processing", "Starting...")
+        videos = payload["videos"]
+        total = len(videos)
+        temp_dir = make_temp_dir(total)
+        # The first probe runs blocking ffmpeg test encodes; keep them off the event loop
+        await asyncio.to_thread(probe_capabilities)
         processor = VideoProcessor(settings.REELS_WIDTH, settings.REELS_HEIGHT, temp_dir)
         
-        downloaded = []
-        for i, video in enumerate(request.videos):
-            await store_job(redis_conn, job_id, "downloading", f"Downloading {i+1}/{len(request.videos)}")
-            downloaded.append(await processor.download_m3u8(str(video.secure_media.reddit_video.hls_url), i))
-        
-        await store_job(redis_conn, job_id, "processing", "Processing videos...")
-        processed = []
-        for i, (path, data) in enumerate(zip(downloaded, request.videos)):
-            await store_job(redis_conn, job_id, "processing", f"Processing {i+1}/{len(request.videos)}")
-            processed.append(await processor.process_video(path, i, data.title, request.overlay_duration))
-        
-        await store_job(redis_conn, job_id, "merging", "Merging videos...")
+        # HLS URLs are prefetched and processed by VideoProcessor in one stage
+        sources = [(v["secure_media"]["reddit_video"]["hls_url"], v["title"]) for v in videos]
         output_path = f"output/{job_id}.mp4"
-        await processor.merge_videos(processed, request.transition_duration, output_path)
+        merged = False
+        if total <= SINGLE_PASS_MAX_CLIPS:
+            await reporter.update("processing", "Processing and merging videos...")
+            try:
+                await processor.process_and_merge(sources, payload["overlay_duration"], output_path)
+                merged = True
+            except asyncio.TimeoutError:
+                # Hit PROCESSING_TIMEOUT; the per-clip path would redo the same encodes
+                raise
+            except Exception as e:
+                # e.g. a clip without audio; the per-clip path handles that
+                logger.warning(f"Single-pass merge failed for job {job_id}, falling back: {e}")
         
-        await store_job(redis_conn, job_id, "completed", "Done!", output=output_path)
+        if not merged:
+            processed = await processor.process_all(sources, payload["overlay_duration"], lambda done: reporter.report("processing", f"Processed {done}/{total}"))
+            await reporter.update("merging", "Merging videos...")
+            await processor.merge_videos(processed, payload["transition_duration"], output_path)
+        
+        await reporter.update("completed", "Done!", output=output_path)
     except Exception as e:
-        await store_job(redis_conn, job_id, "failed", error=str(e))
+        await reporter.update("failed", error=str(e))
     finally:
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir, ignore_errors=True)
-        await redis_conn.close()
+        if temp_dir:
+            remove_temp_dir(temp_dir)
 
 @app.get("/")
 async def root():
@@ -120,7 +270,8 @@ async def health(redis_conn: redis.Redis = Depends(get_redis)):
 async def create_merge_job(request: MergeRequest, background_tasks: BackgroundTasks, redis_conn: redis.Redis = Depends(get_redis)):
     job_id = str(uuid.uuid4())
     await store_job(redis_conn, job_id, "queued", "Queued")
-    background_tasks.add_task(process_merge_job, job_id, request)
+    # Dump once so the background job works on plain dicts and str URLs
+    background_tasks.add_task(process_merge_job, job_id, request.model_dump(mode="json"))
     return JobStatus(job_id=job_id, status="queued", progress="Queued")
 
 @app.get("/api/status/{job_id}", response_model=JobStatus)
@@ -131,11 +282,18 @@ async def get_status(job_id: str, redis_conn: redis.Redis = Depends(get_redis)):
     return JobStatus(job_id=job_id, status=job.get("status", "unknown"), progress=job.get("progress"), output_file=job.get("output_file"), error=job.get("error"))
 
 @app.get("/api/download/{job_id}")
-async def download(job_id: str, redis_conn: redis.Redis = Depends(get_redis)):
+async def download(job_id: str, request: Request, redis_conn: redis.Redis = Depends(get_redis)):
     job = await get_job(redis_conn, job_id)
     if not job or job["status"] != "completed":
         raise HTTPException(status_code=400, detail="Job not completed")
     output_file = job.get("output_file")
-    if not output_file or not os.path.exists(output_file):
+    try:
+        st = os.stat(output_file) if output_file else None
+    except FileNotFoundError:
+        st = None
+    if st is None:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(output_file, media_type="video/mp4", filename=f"merged_{job_id}.mp4")
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"ETag": etag})
+    return FileResponse(output_file, media_type="video/mp4", filename=f"merged_{job_id}.mp4", stat_result=st, headers={"ETag": etag})
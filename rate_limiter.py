@@ -1,16 +1,39 @@
 """
 Rate limiting middleware using Redis
 """
-import time
+import asyncio
 from functools import wraps
 from fastapi import HTTPException, Request
 from fastapi.responses import JSONResponse
-import redis.asyncio as redis
-from config import settings
+from redis.exceptions import ConnectionError as RedisConnectionError
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Atomically increment the counter and set the window TTL on first hit
+RATE_LIMIT_SCRIPT = """
+local current = redis.call('INCR', KEYS[1])
+if current == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return current
+"""
+
+# Circuit breaker: skip rate limiting while Redis is unreachable
+REDIS_TIMEOUT = 0.05
+BREAKER_COOLDOWN = 5.0
+
+_script = None
+_disabled_until = 0.0
+
+
+def _get_script(redis_client):
+    """Register the rate limit script once (EVALSHA with EVAL fallback)"""
+    global _script
+    if _script is None or _script.registered_client is not redis_client:
+        _script = redis_client.register_script(RATE_LIMIT_SCRIPT)
+    return _script
+
 
 def rate_limit(max_requests: int = 10, window: int = 60):
     """
@@ -22,6 +45,8 @@ def rate_limit(max_requests: int = 10, window: int = 60):
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
+            global _disabled_until
+            
             # Get request object from kwargs
             request = kwargs.get('request')
             if not request:
@@ -41,20 +66,22 @@ def rate_limit(max_requests: int = 10, window: int = 60):
             # Create Redis key
             key = f"rate_limit:{client_ip}:{func.__name__}"
             
+            # Imported lazily to avoid a circular import with main
+            from main import get_redis_client
+            redis_client = get_redis_client()
+            loop = asyncio.get_running_loop()
+            if redis_client is None or loop.time() < _disabled_until:
+                # Redis not initialised or breaker open, skip rate limiting
+                return await func(*args, **kwargs)
+            
             try:
-                redis_client = await redis.from_url(
-                    settings.REDIS_URL,
-                    encoding="utf-8",
-                    decode_responses=True
+                # Increment and start the window in a single round trip
+                count = await asyncio.wait_for(
+                    _get_script(redis_client)(keys=[key], args=[window]),
+                    timeout=REDIS_TIMEOUT
                 )
                 
-                # Get current count
-                current = await redis_client.get(key)
-                
-                if current is None:
-                    # First request in window
-                    await redis_client.setex(key, window, 1)
-                elif int(current) >= max_requests:
+                if count > max_requests:
                     # Rate limit exceeded
                     ttl = await redis_client.ttl(key)
                     raise HTTPException(
@@ -62,14 +89,12 @@ def rate_limit(max_requests: int = 10, window: int = 60):
                         detail=f"Rate limit exceeded. Try again in {ttl} seconds.",
                         headers={"Retry-After": str(ttl)}
                     )
-                else:
-                    # Increment counter
-                    await redis_client.incr(key)
-                
-                await redis_client.close()
                 
             except HTTPException:
                 raise
+            except (asyncio.TimeoutError, RedisConnectionError) as e:
+                _disabled_until = loop.time() + BREAKER_COOLDOWN
+                logger.warning(f"Redis unavailable, rate limiting disabled for {BREAKER_COOLDOWN}s: {e!r}")
             except Exception as e:
                 logger.error(f"Rate limiting error: {e}")
                 # Continue without rate limiting if Redis fails
@@ -1,56 +1,367 @@
 import asyncio
 import os
 import logging
-from typing import List
+import shutil
+import subprocess
+import tempfile
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+import aiohttp
+from PIL import Image, ImageDraw, ImageFont
 from config import settings
+from hls_downloader import HlsDownloader
 
 logger = logging.getLogger(__name__)
 
+# HLS read timeout, in microseconds
+RW_TIMEOUT_US = 30_000_000
+
+# Overlay text is rendered once per clip with this font
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+# Presets fast enough for short reels; slower ones barely improve quality
+FAST_PRESETS = {"ultrafast", "superfast", "veryfast", "faster", "fast"}
+
+GOP_SIZE = 60
+GOP_SECONDS = 2
+
+# RAM-backed scratch space, used only within settings.SHM_TEMP_BYTES; reels intermediates are well under this per clip
+SHM_DIR = "/dev/shm"
+CLIP_BYTES_ESTIMATE = 100 * 1024 * 1024
+# tmpfs pages are RAM, so keep this much free for the encoders
+SHM_MEM_HEADROOM = 1024 * 1024 * 1024
+
+# tmpfs bytes reserved by this process's running jobs, keyed by temp dir
+_shm_reserved: Dict[str, int] = {}
+
+# Concurrent hardware encode sessions are capped on consumer GPUs
+HW_ENCODER_CONCURRENCY = 2
+
+# DRM render node used by VAAPI and QSV
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+# Hardware encoders in order of preference, each checked with a one-frame test encode
+HW_ENCODER_TESTS = {
+    "nvenc": ['-c:v', 'h264_nvenc'],
+    "qsv": ['-vf', 'format=nv12', '-c:v', 'h264_qsv'],
+    "vaapi": ['-vaapi_device', VAAPI_DEVICE, '-vf', 'format=nv12,hwupload', '-c:v', 'h264_vaapi'],
+}
+
+# Optional ffmpeg features, keyed by the name used in VideoProcessor._caps
+ENCODER_CAPS = {"nvenc": "h264_nvenc", "vaapi": "h264_vaapi", "qsv": "h264_qsv"}
+FILTER_CAPS = {"zscale": "zscale", "scale_cuda": "scale_cuda", "overlay_cuda": "overlay_cuda"}
+
+def ffmpeg_list(kind: str) -> set:
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', f'-{kind}'], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return set()
+    # Lines look like " V....D h264_nvenc    NVIDIA NVENC H.264 encoder"
+    return {line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 1}
+
+@lru_cache(maxsize=1)
+def probe_capabilities() -> dict:
+    """Probe ffmpeg encoders and filters once per process"""
+    encoders = ffmpeg_list('encoders')
+    filters = ffmpeg_list('filters')
+    caps = {name: encoder in encoders for name, encoder in ENCODER_CAPS.items()}
+    caps.update({name: flt in filters for name, flt in FILTER_CAPS.items()})
+    # Distro builds list hardware encoders even when no GPU is present
+    for name, args in HW_ENCODER_TESTS.items():
+        caps[name] = caps[name] and test_encoder(args)
+    return caps
+
+def test_encoder(args: List[str]) -> bool:
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1', '-frames:v', '1'] + args + ['-f', 'null', '-']
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=10).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+def pick_encoder(caps: dict) -> str:
+    # NVENC, then QSV, then VAAPI, then software libx264
+    for name in HW_ENCODER_TESTS:
+        if caps.get(name) and (name == "nvenc" or os.path.exists(VAAPI_DEVICE)):
+            return name
+    return "libx264"
+
+async def run_ffmpeg(cmd: List[str], timeout: Optional[float] = None, input: Optional[bytes] = None) -> int:
+    stdin = asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL
+    process = await asyncio.create_subprocess_exec(*cmd, stdin=stdin, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(input=input), timeout=timeout)
+    except BaseException:
+        # Timed out or cancelled: kill ffmpeg rather than leave it running
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0 and stderr:
+        logger.error(f"ffmpeg failed: {stderr.decode(errors='replace').strip()}")
+    return process.returncode
+
+def mem_available() -> int:
+    """Available memory in bytes, capped by the cgroup limit inside containers"""
+    available = 0
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        if limit != "max":
+            with open("/sys/fs/cgroup/memory.current") as f:
+                available = min(available, int(limit) - int(f.read()))
+    except (OSError, ValueError):
+        pass
+    return available
+
+def make_temp_dir(clip_count: int) -> str:
+    """Put intermediates on tmpfs when the budget and free memory allow, else under temp/"""
+    needed = 2 * clip_count * CLIP_BYTES_ESTIMATE
+    # Count what running jobs may still write, not just what is on tmpfs now
+    reserved = sum(_shm_reserved.values()) + needed
+    if settings.SHM_TEMP_BYTES and reserved <= settings.SHM_TEMP_BYTES:
+        try:
+            if shutil.disk_usage(SHM_DIR).free >= reserved and mem_available() >= reserved + SHM_MEM_HEADROOM:
+                path = tempfile.mkdtemp(dir=SHM_DIR)
+                _shm_reserved[path] = needed
+                return path
+        except OSError:
+            pass
+    return tempfile.mkdtemp(dir="temp")
+
+def remove_temp_dir(path: str):
+    shutil.rmtree(path, ignore_errors=True)
+    _shm_reserved.pop(path, None)
+
+def move_file(src: str, dst: str):
+    """Rename when possible, else copy in-kernel (reflink on XFS/Btrfs)"""
+    try:
+        os.replace(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                remaining = os.fstat(src_fd).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        if remaining == 0:
+            return
+    except (OSError, AttributeError):
+        pass
+    shutil.copyfile(src, dst)
+
+@lru_cache(maxsize=8)
+def load_font(size: int) -> ImageFont.FreeTypeFont:
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
 class VideoProcessor:
     def __init__(self, width: int, height: int, temp_dir: str):
         self.width = width
         self.height = height
         self.temp_dir = temp_dir
+        self._caps = probe_capabilities()
+        self.encoder = pick_encoder(self._caps)
+        self.concurrency = 1
+        self.overlays = {}
+        self.prefetched = {}
+        if self.encoder == "libx264" and settings.FFMPEG_PRESET not in FAST_PRESETS:
+            logger.warning(f"FFMPEG_PRESET={settings.FFMPEG_PRESET} is slow for short clips; veryfast is recommended")
     
-    async def download_m3u8(self, url: str, index: int) -> str:
-        output_path = os.path.join(self.temp_dir, f"download_{index}.mp4")
-        cmd = ['ffmpeg', '-i', url, '-c', 'copy', '-y', output_path]
-        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        await process.communicate()
-        if process.returncode != 0:
-            raise Exception(f"Download failed")
-        return output_path
+    def render_overlay(self, index: int, title: str) -> str:
+        # A static PNG is blended per frame instead of rasterizing drawtext glyphs
+        key = (index, title)
+        if key in self.overlays:
+            return self.overlays[key]
+        path = os.path.join(self.temp_dir, f"overlay_{index}.png")
+        image = Image.new("RGBA", (self.width, int(self.height * 0.3)), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        for text, size, y in ((f"#{index+1}", 80, 0.15), (title, 40, 0.25)):
+            font = load_font(size)
+            x = (self.width - draw.textlength(text, font=font)) / 2
+            draw.text((x, self.height * y), text, font=font, fill="white")
+        image.save(path)
+        self.overlays[key] = path
+        return path
+    
+    def scale_filter(self) -> str:
+        if self._caps.get("zscale"):
+            # zscale has no force_original_aspect_ratio, so fit the box by expression
+            fit = f"min({self.width}/iw,{self.height}/ih)"
+            return f"zscale=w='trunc({fit}*iw/2)*2':h='trunc({fit}*ih/2)*2':f=lanczos"
+        return f"scale={self.width}:{self.height}:force_original_aspect_ratio=decrease"
+    
+    def pick_concurrency(self, count: int) -> int:
+        if settings.MAX_CONCURRENT_PROCESSING > 0:
+            limit = settings.MAX_CONCURRENT_PROCESSING
+        elif self.encoder != "libx264":
+            limit = HW_ENCODER_CONCURRENCY
+        else:
+            limit = os.cpu_count() or 1
+        return max(1, min(count, limit))
+    
+    async def process_all(self, videos: List[Tuple[str, str]], overlay_duration: float, on_done: Optional[Callable[[int], None]] = None) -> List[str]:
+        self.concurrency = self.pick_concurrency(len(videos))
+        sem = asyncio.Semaphore(self.concurrency)
+        done = 0
+        
+        async def run(index: int, source: str, title: str) -> str:
+            nonlocal done
+            async with sem:
+                output = await self.process_video(source, index, title, overlay_duration)
+            done += 1
+            if on_done:
+                on_done(done)
+            return output
+        
+        results = await asyncio.gather(*(run(i, source, title) for i, (source, title) in enumerate(videos)), return_exceptions=True)
+        # Every clip has finished by now, so raising cannot orphan an ffmpeg
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+    
+    def input_args(self, source: str) -> List[str]:
+        args = ['-i', source]
+        if source.startswith(('http://', 'https://')):
+            args = ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5', '-rw_timeout', str(RW_TIMEOUT_US)] + args
+        if self.encoder == "nvenc":
+            # Decode on the GPU too; the overlay keeps the filters on the CPU
+            args = ['-hwaccel', 'cuda'] + args
+        return args
     
-    def create_overlay_filter(self, index: int, title: str, duration: float) -> str:
-        safe_title = title.replace("'", "\\'").replace(":", "\\:")
+    def device_args(self) -> List[str]:
+        if self.encoder == "vaapi":
+            return ['-vaapi_device', VAAPI_DEVICE]
+        return []
+    
+    def upload_filter(self, label: str, output: str) -> str:
+        # VAAPI encodes from GPU surfaces; the other encoders take system frames
+        if self.encoder == "vaapi":
+            return f";[{label}]format=nv12,hwupload[{output}]"
+        return f";[{label}]null[{output}]"
+    
+    def encoder_args(self) -> List[str]:
+        # Keyframes every GOP_SECONDS in time, so clips of any frame rate concat cleanly
+        keyframes = ['-force_key_frames', f'expr:gte(t,n_forced*{GOP_SECONDS})']
+        if self.encoder == "nvenc":
+            return ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'll', '-rc', 'vbr', '-cq', str(settings.FFMPEG_CRF), '-b:v', '0', '-profile:v', 'high', '-g', str(GOP_SIZE), '-forced-idr', '1', '-strict_gop', '1'] + keyframes
+        if self.encoder == "qsv":
+            return ['-c:v', 'h264_qsv', '-preset', 'veryfast', '-global_quality', str(settings.FFMPEG_CRF), '-g', str(GOP_SIZE)] + keyframes
+        if self.encoder == "vaapi":
+            return ['-c:v', 'h264_vaapi', '-qp', str(settings.FFMPEG_CRF), '-g', str(GOP_SIZE)] + keyframes
+        # A fixed GOP gives every clip identical keyframe boundaries for concat
+        x264_params = f"keyint={GOP_SIZE}:min-keyint={GOP_SIZE}:scenecut=0"
+        if settings.FFMPEG_PRESET in ('ultrafast', 'superfast'):
+            # Sliced threads have lower latency on short clips at fast presets
+            x264_params += ":sliced-threads=1"
+        return ['-c:v', 'libx264', '-preset', settings.FFMPEG_PRESET, '-crf', str(settings.FFMPEG_CRF), '-threads', '0', '-x264-params', x264_params] + keyframes
+    
+    def thread_args(self) -> List[str]:
+        # Split cores between concurrent ffmpegs so they don't oversubscribe
+        filter_threads = max(1, (os.cpu_count() or 1) // self.concurrency)
+        return ['-filter_complex_threads', str(filter_threads)]
+    
+    def clip_filter(self, index: int, video: str, overlay: str, output: str, overlay_duration: float) -> str:
+        # The single-frame overlay input repeats, but is only shown for the first overlay_duration seconds
         return (
-            f"drawtext=fontsize=80:fontcolor=white:x=(w-text_w)/2:y=h*0.15:text='#{index+1}',"
-            f"drawtext=fontsize=40:fontcolor=white:x=(w-text_w)/2:y=h*0.25:text='{safe_title}'"
+            f"[{video}]{self.scale_filter()},pad={self.width}:{self.height}:(ow-iw)/2:(oh-ih)/2:black,setsar=1[bg{index}];"
+            f"[bg{index}][{overlay}]overlay=0:0:enable='lte(t,{overlay_duration})'[{output}]"
         )
     
-    async def process_video(self, video_path: str, index: int, title: str, overlay_duration: float) -> str:
-        output_path = os.path.join(self.temp_dir, f"processed_{index}.mp4")
-        overlay_filter = self.create_overlay_filter(index, title, overlay_duration)
-        filter_complex = f"[0:v]scale={self.width}:{self.height}:force_original_aspect_ratio=decrease,pad={self.width}:{self.height}:(ow-iw)/2:(oh-ih)/2:black,{overlay_filter}[v]"
-        cmd = ['ffmpeg', '-i', video_path, '-filter_complex', filter_complex, '-map', '[v]', '-map', '0:a?', '-c:v', 'libx264', '-preset', settings.FFMPEG_PRESET, '-crf', str(settings.FFMPEG_CRF), '-c:a', 'aac', '-y', output_path]
-        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        await process.communicate()
-        if process.returncode != 0:
-            raise Exception(f"Processing failed")
+    async def prefetch(self, source: str, index: int) -> str:
+        # Fetch HLS segments in parallel; ffmpeg alone downloads them serially
+        if not source.startswith(('http://', 'https://')):
+            return source
+        if index in self.prefetched:
+            return self.prefetched[index]
+        try:
+            timeout = aiohttp.ClientTimeout(total=settings.DOWNLOAD_TIMEOUT)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                downloader = HlsDownloader(session, os.path.join(self.temp_dir, f"clip_{index}", "hls"))
+                self.prefetched[index] = await downloader.download(source)
+                return self.prefetched[index]
+        except Exception as e:
+            logger.warning(f"Prefetch of video {index} failed, streaming it with ffmpeg instead: {e}")
+            return source
+    
+    async def process_video(self, source: str, index: int, title: str, overlay_duration: float) -> str:
+        clip_dir = os.path.join(self.temp_dir, f"clip_{index}")
+        os.makedirs(clip_dir, exist_ok=True)
+        source = await self.prefetch(source, index)
+        output_path = os.path.join(clip_dir, "processed.mp4")
+        overlay_path = await asyncio.to_thread(self.render_overlay, index, title)
+        filter_complex = self.clip_filter(index, "0:v", "1:v", "clip", overlay_duration) + self.upload_filter("clip", "v")
+        cmd = ['ffmpeg', '-loglevel', 'error'] + self.thread_args() + self.device_args() + self.input_args(source) + ['-i', overlay_path, '-filter_complex', filter_complex, '-map', '[v]', '-map', '0:a?'] + self.encoder_args() + ['-bsf:v', 'h264_metadata=aud=insert', '-c:a', 'aac', '-y', output_path]
+        timeout = settings.PROCESSING_TIMEOUT or None
+        for attempt in range(settings.MAX_RETRIES):
+            try:
+                returncode = await run_ffmpeg(cmd, timeout=timeout)
+            except asyncio.TimeoutError:
+                # Re-running the same encode would only time out again
+                raise asyncio.TimeoutError(f"Processing video {index} timed out after {timeout}s")
+            if returncode == 0:
+                return output_path
+            if attempt < settings.MAX_RETRIES - 1:
+                logger.warning(f"Processing video {index} failed, retrying ({attempt + 1}/{settings.MAX_RETRIES})")
+                await asyncio.sleep(2 ** attempt)
+        raise Exception(f"Processing failed")
+    
+    async def process_and_merge(self, videos: List[Tuple[str, str]], overlay_duration: float, output_path: str) -> str:
+        # One decode-filter-encode pass for all clips; every input needs an audio stream
+        count = len(videos)
+        sources = await asyncio.gather(*(self.prefetch(source, i) for i, (source, _) in enumerate(videos)))
+        overlay_paths = [await asyncio.to_thread(self.render_overlay, i, title) for i, (_, title) in enumerate(videos)]
+        # Clip inputs come first, overlay PNGs follow at index count + i
+        graph = [self.clip_filter(i, f"{i}:v", f"{count + i}:v", f"v{i}", overlay_duration) for i in range(count)]
+        graph.append("".join(f"[v{i}][{i}:a]" for i in range(count)) + f"concat=n={count}:v=1:a=1[merged][a]" + self.upload_filter("merged", "v"))
+        inputs = [arg for source in sources for arg in self.input_args(source)]
+        inputs += [arg for path in overlay_paths for arg in ('-i', path)]
+        cmd = ['ffmpeg', '-loglevel', 'error'] + self.thread_args() + self.device_args() + inputs + ['-filter_complex', ';'.join(graph), '-map', '[v]', '-map', '[a]'] + self.encoder_args() + ['-c:a', 'aac', '-movflags', '+faststart', '-y', output_path]
+        timeout = settings.PROCESSING_TIMEOUT * count or None
+        try:
+            returncode = await run_ffmpeg(cmd, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError(f"Single-pass merge timed out after {timeout}s")
+        if returncode != 0:
+            raise Exception(f"Single-pass merge failed")
+        return output_path
+    
+    async def remux_to_ts(self, video_path: str, index: int) -> str:
+        output_path = os.path.join(self.temp_dir, f"merge_{index}.ts")
+        cmd = ['ffmpeg', '-loglevel', 'error', '-i', video_path, '-c', 'copy', '-bsf:v', 'h264_mp4toannexb', '-f', 'mpegts', '-y', output_path]
+        if await run_ffmpeg(cmd) != 0:
+            raise Exception(f"Remux failed")
         return output_path
     
     async def merge_videos(self, processed_videos: List[str], transition_duration: float, output_path: str) -> str:
         if len(processed_videos) == 1:
-            import shutil
-            shutil.copy(processed_videos[0], output_path)
+            # The intermediate is discarded with temp_dir, so it can be moved
+            await asyncio.to_thread(move_file, processed_videos[0], output_path)
             return output_path
-        concat_file = os.path.join(self.temp_dir, "concat.txt")
-        with open(concat_file, 'w') as f:
-            for video in processed_videos:
-                f.write(f"file '{os.path.abspath(video)}'\n")
-        cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', concat_file, '-c', 'copy', '-y', output_path]
-        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        await process.communicate()
-        if process.returncode != 0:
+        # MPEG-TS joins safely with stream copy even if the MP4 extradata differs
+        ts_videos = await asyncio.gather(*(self.remux_to_ts(video, i) for i, video in enumerate(processed_videos)))
+        # The concat demuxer escapes a quote inside a quoted path as '\''
+        payload = "".join("file '" + os.path.abspath(video).replace("'", "'\\''") + "'\n" for video in ts_videos).encode()
+        # Feed the list over stdin instead of writing a concat file
+        cmd = ['ffmpeg', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-protocol_whitelist', 'file,pipe', '-i', 'pipe:0', '-c', 'copy', '-bsf:a', 'aac_adtstoasc', '-movflags', '+faststart', '-y', output_path]
+        if await run_ffmpeg(cmd, input=payload) != 0:
             raise Exception(f"Merge failed")
         return output_path